@@ -1,8 +1,9 @@
-from pydub import AudioSegment
+import mmap
 import os
-from mutagen.id3 import ID3NoHeaderError
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, TIT2, TALB, TPE1, TPE2, COMM, TCOM, TCON, TDRC, TRCK, APIC
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from mutagen.mp3 import MP3, BitrateMode
+from mutagen.id3 import ID3, TIT2, TALB, TPE1, TRCK, APIC
 
 
 class Track:
@@ -15,8 +16,7 @@ class Track:
         :param sep1: the separator in the time format, e.g. ':' in '00:30'
         :param sep2: the separator between the time stamp and the title, e.g. ' ' in '00:30 Red Sky'
         """
-        ind = data.find(sep2)
-        t1, t2 = data[:ind], data[ind+1:]
+        t1, t2 = data.split(sep2, 1)
 
         self.num = num
         self.title = t2
@@ -26,8 +26,11 @@ class Track:
         # usually left None and updated as the next track's start time
         self.end_time = None
 
+        # cached, since it's used both for printing and as the output file name
+        self._repr = f'{num}. {t2}'
+
     def __repr__(self):
-        return f'{self.num}. {self.title}'
+        return self._repr
 
     def __lt__(self, other):
         # used for sorting tracks in album, by track number
@@ -43,22 +46,19 @@ class Track:
         :param sep: the separator in the time format, e.g. in 02:03 the sep is ':'
         :return: int, time in milliseconds
         """
-        l = time_string.split(sep)
-
-        # count how many separators are there to check if there are more than 0 hours
-        sep_count = time_string.count(sep)
-        hours = 0
-        if sep_count == 1:
-            mins = int(l[0])
-            secs = int(l[1])
-        elif sep_count == 2:
-            hours = int(l[0])
-            mins = int(l[1])
-            secs = int(l[2])
+        parts = time_string.split(sep)
+
+        # the number of parts tells if there are more than 0 hours
+        n = len(parts)
+        if n == 2:
+            hours = 0
+            mins, secs = parts
+        elif n == 3:
+            hours, mins, secs = parts
         else:
-            raise ValueError(f'number of {sep} in timestamp {time_string} is invalid ({sep_count})')
+            raise ValueError(f'number of {sep} in timestamp {time_string} is invalid ({n - 1})')
 
-        return (secs + mins*60 + hours*60*60) * 1000
+        return (int(secs) + int(mins)*60 + int(hours)*3600) * 1000
 
 
 class Album:
@@ -80,13 +80,12 @@ class Album:
         self.artist = artist
         self.output_path = output_path
         self.cover_path = cover_path
-        self.tracks = []
 
+        # read the whole tracklist in one go, skipping empty lines
         with open(filepath, 'r') as f:
-            i = 1
-            for line in f:
-                self.tracks.append(Track(line.strip(), i, sep1, sep2))
-                i += 1
+            lines = [line.strip() for line in f.read().splitlines() if line.strip()]
+
+        self.tracks = [Track(line, i, sep1, sep2) for i, line in enumerate(lines, 1)]
 
         # add the end time to each track, copied from the start time of the track after it
         self.add_end_times()
@@ -99,136 +98,274 @@ class Album:
         return len(self.tracks)
 
 
-def split_mp3(album, to_print=True):
+def extract_track(job):
     """
-    splits a source mp3 track to an album, based on an Album instance
+    extracts a single track from the source mp3 using ffmpeg, copying the mp3 frames as-is
+    without decoding and re-encoding the audio
+    the meta data and cover art are written by ffmpeg in the same pass
 
-    :param album: an Album instance
-    :param to_print: a boolean, if True the function will print messages indicating progress
+    :param job: a tuple of (source path, start time in ms, end time in ms or None, output path,
+                meta data dict, cover art path or None)
     """
-    source = AudioSegment.from_mp3(album.audio_path)
-    overall = len(album)  # number of tracks
+    src, start_time, end_time, out_path, meta, cover_path = job
 
-    if to_print:
-        print(f'SPLITTING ALBUM: {album.name}...')
+    # seek before the input (-ss before -i) for a fast seek
+    cmd = ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-y', '-ss', f'{start_time / 1000:.3f}']
 
-    # all but the last track, cause it doesn't end at the start time of the track after it
-    i = 1
-    for track in album.tracks[:-1]:
-        cur_song = source[track.start_time:track.end_time]
-        cur_song.export(f'{album.output_path}\\{str(track)}.mp3', format="mp3")
+    # the last track has no end time, it runs until the end of the source
+    if end_time is not None:
+        cmd += ['-to', f'{end_time / 1000:.3f}']
 
-        if to_print:
-            print(f'{str(track)}.mp3 >> SPLIT ({i}/{overall})')
-            i += 1
+    cmd += ['-i', src]
+    if cover_path:
+        cmd += ['-i', cover_path]
 
-    # handling end time for last track and exporting it
-    last = album.tracks[-1]
-    last_song = source[last.start_time:]
-    last_song.export(f'{album.output_path}\\{str(last)}.mp3', format="mp3")
+    cmd += ['-map', '0:a']
+    if cover_path:
+        # the cover is attached as a picture stream, which the mp3 muxer writes as an APIC frame
+        cmd += ['-map', '1:v', '-metadata:s:v', 'title=Cover', '-metadata:s:v', 'comment=Cover (front)']
 
-    if to_print:
-        print(f'{str(last)}.mp3 >> SPLIT ({i}/{overall})')
+    # don't carry over the source's own tags, only the ones set below are written
+    cmd += ['-map_metadata', '-1', '-c', 'copy', '-id3v2_version', '3']
+    for key, value in meta.items():
+        cmd += ['-metadata', f'{key}={value}']
+
+    cmd += [out_path]
+    subprocess.run(cmd, check=True)
+
+
+# layer iii bitrates in kbps by bitrate index, for mpeg 1 and for mpeg 2 / 2.5
+BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+# sample rates in Hz by sample rate index, keyed by the 2 mpeg version bits of the header (01 is reserved)
+SAMPLE_RATES = {
+    0b11: (44100, 48000, 32000),  # mpeg 1
+    0b10: (22050, 24000, 16000),  # mpeg 2
+    0b00: (11025, 12000, 8000),  # mpeg 2.5
+}
+
+
+def frame_info(mm, pos):
+    """
+    parses the mp3 (mpeg layer iii) frame header at a given position in the source
+
+    :param mm: the source mp3, an mmap (or bytes)
+    :param pos: int, byte offset of the frame header
+    :return: a tuple of (frame length in bytes, frame duration in ms), or None if there is no valid header there
+    """
+    if pos + 4 > len(mm) or mm[pos] != 0xFF or mm[pos+1] & 0xE0 != 0xE0:
+        return None
+
+    version = mm[pos+1] >> 3 & 0b11
+    layer = mm[pos+1] >> 1 & 0b11
+    bitrate_index = mm[pos+2] >> 4
+    rate_index = mm[pos+2] >> 2 & 0b11
+    if version not in SAMPLE_RATES or layer != 0b01 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 0b11
+    bitrate = BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = mm[pos+2] >> 1 & 1
 
+    # a frame holds 1152 samples for mpeg 1, and 576 for mpeg 2 / 2.5
+    samples = 1152 if mpeg1 else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples * 1000 / sample_rate
 
-def edit_meta(song_path, title, artist, album, track_num, cover):
+
+def find_frame(mm, pos):
     """
-    edits the meta data of a single mp3 track
-
-    :param song_path: mp3 file path
-    :param title: new title
-    :param artist: new artist
-    :param album: new album name
-    :param track_num: new track num
-    :param cover: new cover art
+    finds the first valid mp3 frame header starting at or after a given position in the source
+
+    :param mm: the source mp3, an mmap (or bytes)
+    :param pos: int, byte offset to start searching from
+    :return: int, the offset of the frame, or None if there is none
     """
-    try:
-        tags = ID3(song_path)
-    except ID3NoHeaderError:
-        tags = ID3()
-
-    # update title, artist, album, track num
-    tags["TIT2"] = TIT2(encoding=3, text=title)
-    tags["TPE1"] = TPE1(encoding=3, text=artist)
-    tags["TALB"] = TALB(encoding=3, text=album)
-    tags["TRCK"] = TRCK(encoding=3, text=str(track_num))
-    tags.save(song_path)
-
-    # update cover art, if one was provided
-    if cover is not None:
-        audio = MP3(song_path, ID3=ID3)
-        audio.tags.add(
-            APIC(
-                encoding=3,
-                mime=f'image/{os.path.splitext(cover)[1]}',
-                type=3,
-                desc=u'Cover',
-                data=open(cover, 'rb').read()
-            )
-        )
-        audio.save(v2_version=3)
-
-
-def edit_album_meta(album, to_print=True):
+    while True:
+        pos = mm.find(b'\xff', pos)
+        if pos == -1:
+            return None
+
+        if frame_info(mm, pos) is not None:
+            return pos
+
+        pos += 1
+
+
+def cbr_frames(mm):
+    """
+    finds the offsets of all the audio frames in a constant bitrate mp3, checking that they form an unbroken chain
+    of frames with the same header, each starting right where the one before it ends
+
+    :param mm: the source mp3, an mmap (or bytes)
+    :return: a tuple of (list of frame offsets, end of the audio, frame duration in ms),
+             or None if the source isn't a consistent cbr stream
+    """
+    # skip the source's id3v2 tag, its size is stored as a 28 bit "syncsafe" int
+    start = 0
+    if mm[:3] == b'ID3':
+        start = 10 + (mm[6] << 21 | mm[7] << 14 | mm[8] << 7 | mm[9])
+        if mm[5] & 0x10:  # footer present
+            start += 10
+
+    first = find_frame(mm, start)
+    if first is None:
+        return None
+
+    # a file encoded by lame starts with an "Info" (or "Xing") frame that holds no audio, skip it by its own length,
+    # its bitrate can be higher than the audio's, when the tag doesn't fit in a frame at the stream bitrate
+    audio_start = first
+    length, _ = frame_info(mm, first)
+    if mm.find(b'Info', first, first + length) != -1 or mm.find(b'Xing', first, first + length) != -1:
+        audio_start = first + length
+
+    info = frame_info(mm, audio_start)
+    if info is None:
+        return None
+    frame_ms = info[1]
+
+    # don't copy the source's id3v1 tag into the last track
+    audio_end = len(mm) - 128 if mm[-128:-125] == b'TAG' else len(mm)
+
+    # in a cbr file all frame headers are the same, except for the padding bit
+    header1, header2 = mm[audio_start+1], mm[audio_start+2] & 0xFD
+
+    frames = []
+    pos = audio_start
+    while pos < audio_end:
+        if pos + 4 > audio_end or mm[pos] != 0xFF or mm[pos+1] != header1 or mm[pos+2] & 0xFD != header2:
+            return None
+
+        frames.append(pos)
+        pos += frame_info(mm, pos)[0]
+
+    return frames, audio_end, frame_ms
+
+
+def split_mp3_fast(album, to_print=True):
     """
-    edits the meta data for all the tracks in a given album
+    splits a constant bitrate source mp3 to an album, based on an Album instance
+    in a cbr mp3 every frame takes the same number of bytes, so each track is copied straight from the
+    source as a byte range of whole frames, with no decoding or ffmpeg at all
+    nothing is written if the source's frames can't be verified, or the tracks don't fit in it
 
     :param album: an Album instance
     :param to_print: a boolean, if True the function will print messages indicating progress
+    :return: a boolean, True if the album was split, False if the source isn't suitable for this
     """
-    if to_print:
-        print('\nEDITING META DATA...')
+    overall = len(album)  # number of tracks
+    out_dir = os.fspath(album.output_path)
+
+    # the tracks are written from a memoryview over the mapped source, so slicing them doesn't copy the audio
+    with open(album.audio_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            memoryview(mm) as view:
+        chain = cbr_frames(mm)
+        if chain is None:
+            return False
+        frames, audio_end, frame_ms = chain
+
+        # the byte range of each track, from the frame closest to its start time to the one closest to its end time
+        ranges = []
+        for track in album.tracks:
+            first = round(track.start_time / frame_ms)
+            last = len(frames) if track.end_time is None else min(round(track.end_time / frame_ms), len(frames))
+            if first >= last:
+                return False  # the track starts past the end of the audio
+
+            ranges.append((frames[first], frames[last] if last < len(frames) else audio_end))
+
+        cover = None
+        if album.cover_path:
+            with open(album.cover_path, 'rb') as c:
+                data = c.read()
+
+            ext = os.path.splitext(album.cover_path)[1].lstrip('.').lower()
+            cover = APIC(encoding=3, mime=f'image/{"jpeg" if ext == "jpg" else ext}', type=3, desc=u'Cover', data=data)
 
-    count = 1  # for track numbering
-    overall = len(album.tracks)  # number of tracks
+        if to_print:
+            print(f'SPLITTING ALBUM: {album.name}...')
 
-    # go over the files in the output folder
-    for path, dirs, files in os.walk(album.output_path):
-        # sort the files by track number
-        files.sort(key=get_track_num)
+        for i, (track, (begin, end)) in enumerate(zip(album.tracks, ranges), 1):
+            tags = ID3()
+            tags["TIT2"] = TIT2(encoding=3, text=track.title)
+            tags["TPE1"] = TPE1(encoding=3, text=album.artist)
+            tags["TALB"] = TALB(encoding=3, text=album.name)
+            tags["TRCK"] = TRCK(encoding=3, text=str(track.num))
+            if cover is not None:
+                tags.add(cover)
 
-        # go over both the sorted files, and the track objects in the album, in tandem
-        for file, track in zip(files, album.tracks):
-            if file[-3:] == 'mp3':
-                cur_path = os.path.join(path, file)
-                edit_meta(cur_path, track.title, album.artist, album.name, count, album.cover_path)
+            # write the tags to an empty file, and append the audio after them, so the file is written once
+            out_path = os.path.join(out_dir, f'{str(track)}.mp3')
+            open(out_path, 'wb').close()
+            tags.save(out_path, v2_version=3)
+            with open(out_path, 'r+b') as out:
+                offset = out.seek(0, os.SEEK_END)
 
-                if to_print:
-                    print(f"{str(track)}.mp3 >> DONE ({count}/{overall})")
+                # reserve the track's space up front, so the filesystem can give it one contiguous extent
+                if hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(out.fileno(), offset, end - begin)
+                    except OSError:
+                        pass  # not supported by this filesystem, the write below still works
 
-                count += 1
+                out.write(view[begin:end])
 
+            if to_print:
+                print(f'{str(track)}.mp3 >> SPLIT ({i}/{overall})')
 
-def get_info(info_path):
+    return True
+
+
+def split_mp3(album, to_print=True):
     """
-    goes over the configuration text file and extracts the relevant data
-    :param info_path: path to the config file
-    :return: a tuple including: (audio_path, tracklist_path, cover_path, output_path, name, artist)
+    splits a source mp3 track to an album, based on an Album instance
+    constant bitrate sources are split by copying each track's frames straight from the source (see split_mp3_fast)
+    any other source, or a cbr one whose frames can't be verified, is split with ffmpeg, and since the tracks are
+    independent of each other, they are extracted in parallel, one process per cpu
+    either way, each track is tagged with its title, artist, album name, track number and cover art as it is written
+
+    :param album: an Album instance
+    :param to_print: a boolean, if True the function will print messages indicating progress
     """
-    lines = []
-    with open(info_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line == '':
-                continue
+    # constant bitrate sources don't need ffmpeg, their tracks can be copied byte for byte
+    if MP3(album.audio_path).info.bitrate_mode == BitrateMode.CBR and split_mp3_fast(album, to_print):
+        return
 
-            if line[0] == '"':
-                line = line.strip('"')
+    overall = len(album)  # number of tracks
 
-            lines.append(line)
+    if to_print:
+        print(f'SPLITTING ALBUM: {album.name}...')
 
-    return tuple(lines)
+    out_dir = os.fspath(album.output_path)
 
+    jobs = []
+    for track in album.tracks:
+        meta = {'title': track.title, 'artist': album.artist, 'album': album.name, 'track': str(track.num)}
+        jobs.append((album.audio_path, track.start_time, track.end_time, os.path.join(out_dir, f'{str(track)}.mp3'),
+                     meta, album.cover_path))
 
-def get_track_num(song_name):
-    """
-    gets the track number from a song file name, e.g. '05. Swim.mp3' => 5
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        # map returns the results in submission order, so the progress lines stay in track order
+        for i, (track, _) in enumerate(zip(album.tracks, ex.map(extract_track, jobs)), 1):
+            if to_print:
+                print(f'{str(track)}.mp3 >> SPLIT ({i}/{overall})')
 
-    :param song_name: string, song file name
-    :return: int, track number
+
+def get_info(info_path):
+    """
+    goes over the configuration text file and extracts the relevant data
+    :param info_path: path to the config file
+    :return: a tuple including: (audio_path, tracklist_path, cover_path, output_path, name, artist)
     """
-    ind = song_name.find('.')
-    return int(song_name[:ind])
+    with open(info_path, 'r') as f:
+        data = f.read()
+
+    # skip empty lines, and remove the quotes around quoted paths
+    lines = (line.strip() for line in data.splitlines())
+    return tuple(line.strip('"') if line[0] == '"' else line for line in lines if line)
 
 
 if __name__ == '__main__':
@@ -239,8 +376,7 @@ if __name__ == '__main__':
     # create album
     A = Album(tracklist_path, audio_path, name, artist, output_path, cover_path, ':', ' ')
 
-    # split audio to tracks and edit meta data
+    # split audio to tagged tracks
     split_mp3(A)
-    edit_album_meta(A)
 
     input('\nPress any key to exit...')